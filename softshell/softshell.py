@@ -1,7 +1,9 @@
 import argparse
-import copy
-import fileinput
+import concurrent.futures
+import hashlib
+import io
 import itertools
+import json
 import logging
 import os
 import re
@@ -9,20 +11,34 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from pprint import pprint
 
 import yaml
 
-from softshell.exceptions import VariableNotFoundError, LoadConfigError, FileEditFailedError
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+from softshell.exceptions import VariableNotFoundError, VariableNotDeclaredAtLineError, \
+    LoadConfigError, FileEditFailedError
 
 REGEX_SEARCH = r'({}\s*=)[^\),]*'
 REGEX_EXTRACT = r'=\s*[\"\']*(.*?)[\"\']*[\s\),;]*$'
+REGEX_EXTRACT_COMPILED = re.compile(REGEX_EXTRACT)
+
+CONFIG_CACHE_SUFFIX = '.json.cache'
+
+# Directories left out of the working directory copies made for parallel workers
+WORKDIR_SKIPPED_DIRS = ('.git', '.hg', '.svn', '__pycache__', '.mypy_cache', '.pytest_cache',
+                        '.tox', '.nox')
 
 LOGGER = logging.getLogger(__name__)
 
 
-def _edit_line(line, var_name, value):
+def _edit_line(line, var_name, value, search_re, extract_re=REGEX_EXTRACT_COMPILED):
     """
     Edits the value of a variable on a given line
 
@@ -30,54 +46,130 @@ def _edit_line(line, var_name, value):
         line (str): The line with the variable to change
         var_name (str): Name of the variable to change
         value (str): Value to replace the current value with
+        search_re (re.Pattern): Compiled REGEX_SEARCH for var_name
+        extract_re (re.Pattern): Compiled REGEX_EXTRACT
     Returns:
         (str) Edited line
     Raises:
         VariableNotFoundError
+        VariableNotDeclaredAtLineError
     """
-    if var_name not in line:
+    pos = line.find(var_name)
+    if pos < 0:
         raise VariableNotFoundError('Variable {} could not be found in line'.format(var_name))
 
-    # Find the portion to edit
+    # Find the portion to edit, starting from where the variable name first appears
     # This should get something like 'var_name=original_value'
-    portion_to_edit = re.search(REGEX_SEARCH.format(var_name), line).group(0)
+    match_portion = search_re.search(line, pos)
+    if match_portion is None:
+        raise VariableNotDeclaredAtLineError('Variable {} is not assigned in line'.format(var_name))
 
-    # Extract the value after the '=' operator
-    var_value = re.search(REGEX_EXTRACT, portion_to_edit).group(1)
+    # Locate the value after the '=' operator within that portion
+    match_value = extract_re.search(match_portion.group(0))
 
-    # replace the value
-    edited_text = re.sub(var_value, value, portion_to_edit)
-
-    # Now edit the entire line
-    edited_line = re.sub(portion_to_edit, edited_text, line)
+    # Splice the new value in place of the old one
+    value_start = match_portion.start() + match_value.start(1)
+    value_end = match_portion.start() + match_value.end(1)
+    edited_line = line[:value_start] + value + line[value_end:]
 
     return edited_line
 
 
-def _create_back_up(path):
+def _compile_search_patterns(var_names):
     """
-    Creates a temporary backup file
+    Compiles REGEX_SEARCH for each variable
+    Args:
+        var_names (iterable): Names of the variables
+
+    Returns:
+        (dict) mapping of var_name => compiled pattern
+    """
+    return {var_name: re.compile(REGEX_SEARCH.format(var_name)) for var_name in var_names}
+
+
+def _snapshot(path):
+    """
+    Takes an in-memory snapshot of a file
     Args:
         path (str): Path to original file
 
     Returns:
-        (str): Path to temporary file
+        (bytes): Contents of the file
     """
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-    shutil.copy(path, temp_file.name)
-    return temp_file.name
+    with open(path, 'rb') as fp:
+        return fp.read()
 
 
-def _restore_file(temp_file, path):
+def _split_lines(snapshot):
     """
+    Splits a snapshot into lines the same way reading the file in text mode would
     Args:
-        temp_file (str): Path to the temporary file 
-        path (str): Path to the original file 
+        snapshot (bytes): Contents of the file
+
+    Returns:
+        (list) Lines of the file, including line endings
+    """
+    return io.TextIOWrapper(io.BytesIO(snapshot)).readlines()
+
+
+def _replace_file(path, chunks, mode='w'):
+    """
+    Writes to a temporary file next to the original, then renames it over the original
+
+    Symlinks are followed so the file they point to is replaced rather than the link.
+    Files with other hard links, in directories that cannot be written to, or whose
+    owner cannot be kept, are written in place instead.
+
+    Args:
+        path (str): Path to the original file
+        chunks (list): Strings (or bytes) to write
+        mode (str): Mode to open the temporary file with
+
+    Returns:
+        None
+    """
+    real_path = os.path.realpath(path)
+    stat_result = os.stat(real_path)
+
+    if stat_result.st_nlink == 1:
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(real_path),
+                                             delete=False) as temp_file:
+                temp_path = temp_file.name
+                temp_file.writelines(chunks)
+            shutil.copymode(real_path, temp_path)
+            temp_stat_result = os.stat(temp_path)
+            if (temp_stat_result.st_uid, temp_stat_result.st_gid) != \
+                    (stat_result.st_uid, stat_result.st_gid):
+                os.chown(temp_path, stat_result.st_uid, stat_result.st_gid)
+            os.replace(temp_path, real_path)
+            return
+        except PermissionError:
+            # The directory is read-only or the owner could not be kept;
+            # fall back to writing in place
+            if temp_path is not None:
+                os.remove(temp_path)
+        except:
+            if temp_path is not None:
+                os.remove(temp_path)
+            raise
+
+    with open(real_path, mode) as fp:
+        fp.writelines(chunks)
+
+
+def _restore_file(snapshot, path):
+    """
+    Restores a file from its snapshot; if path is a symlink, the file it points to is restored
+    Args:
+        snapshot (bytes): Contents of the original file
+        path (str): Path to the original file
 
     Returns:
         None
     """
-    shutil.copy(temp_file, path)
+    _replace_file(path, [snapshot], mode='wb')
 
 
 def _restore_from_dict(dict_files):
@@ -85,30 +177,34 @@ def _restore_from_dict(dict_files):
     Restores files from dictionary
 
     Args:
-        dict_files (dict): mapping of path => temp path
+        dict_files (dict): mapping of path => snapshot
 
     Returns:
         None
     """
-    for (path, temp) in dict_files.items():
-        _restore_file(temp, path)
+    for (path, snapshot) in dict_files.items():
+        _restore_file(snapshot, path)
 
 
-def _clear_from_dict(dict_files):
+def _get_line(lines, line_number):
     """
-    Clear temp files from dictionaries
-
+    Gets a line by its line number
     Args:
-        dict_files (dict): mapping of path => temp path
+        lines (list): Lines of the file
+        line_number (int): Line number, starting from 1
 
     Returns:
-        None
+        (str) The line
+
+    Raises:
+        VariableNotFoundError
     """
-    for temp in dict_files.values():
-        os.remove(temp)
+    if not 1 <= line_number <= len(lines):
+        raise VariableNotFoundError('Line {} does not exist'.format(line_number))
+    return lines[line_number - 1]
 
 
-def edit_file(path, tuples):
+def edit_file(path, tuples, snapshot=None, lines=None, dict_var_name_to_search_re=None):
     """
     Edit a file
 
@@ -118,9 +214,18 @@ def edit_file(path, tuples):
             line_number (int): Line number to look at
             var_name (str): Name of the variable
             replace_value (str): Value to insert
+        snapshot (bytes): Original contents of the file; read from path if not given
+        lines (list): Original lines of the file; split from snapshot if not given
+        dict_var_name_to_search_re (dict): mapping of var_name => compiled REGEX_SEARCH;
+            compiled here if not given
 
     Returns:
-        (bool) Successful or not
+        (bytes) Snapshot of the file before editing
+
+    Raises:
+        VariableNotFoundError
+        VariableNotDeclaredAtLineError
+        FileEditFailedError
     """
     # create a dictionary that maps line number to a list of (var_name, replace_value) tuples
     dict_line_number_to_pairs = {}
@@ -130,40 +235,54 @@ def edit_file(path, tuples):
         else:
             dict_line_number_to_pairs[line_number] = [(var_name, replace_value)]
 
-    # Copy the original file to a temporary location
-    temp_file = _create_back_up(path)
-    LOGGER.info('Temporary file of {} created at: {}'.format(path, temp_file))
+    # Compile the search pattern of each variable once rather than once per edit
+    if dict_var_name_to_search_re is None:
+        dict_var_name_to_search_re = _compile_search_patterns(
+            var_name for (_, var_name, _) in tuples)
+
+    # Keep the original contents in memory so the file can be restored
+    if snapshot is None:
+        snapshot = _snapshot(path)
+        LOGGER.info('Snapshot of {} taken'.format(path))
 
-    # Queue in which parsed lines are stored
     try:
-        list_temporary_buffer = []
-        for idx, line in enumerate(fileinput.FileInput(files=(path))):
+        if lines is None:
+            lines = _split_lines(snapshot)
+
+        # Only visit the lines that have edits; the copy shares every other line
+        new_lines = list(lines)
+        for line_num, pairs in sorted(dict_line_number_to_pairs.items()):
             # Line numbers start from 1, not 0
-            line_num = idx + 1
-            if line_num in dict_line_number_to_pairs:
-                for (var_name, replace_value) in dict_line_number_to_pairs[line_num]:
-                    LOGGER.info('Configuration: {}'.format((line_num, var_name, replace_value)))
-                    line = _edit_line(line, var_name, str(replace_value))
-            list_temporary_buffer.append(line)
-
-        # Save buffer
-        fp = open(path, 'w+')
-        fp.writelines(list_temporary_buffer)
-        fp.close()
+            line = _get_line(lines, line_num)
+            for (var_name, replace_value) in pairs:
+                LOGGER.info('Configuration: {}'.format((line_num, var_name, replace_value)))
+                line = _edit_line(line, var_name, str(replace_value),
+                                  dict_var_name_to_search_re[var_name])
+            new_lines[line_num - 1] = line
+
+        # Write to a temporary file that atomically replaces the original,
+        # so a failure part-way through never leaves a half-written file behind
+        _replace_file(path, [''.join(new_lines)])
         LOGGER.info('Editing {} was successful'.format(path))
     except VariableNotFoundError as e:
         raise VariableNotFoundError('In {}: {}'.format(path, e.message))
+    except VariableNotDeclaredAtLineError as e:
+        raise VariableNotDeclaredAtLineError('In {}: {}'.format(path, e.message))
     except:
-        LOGGER.critical('Failed to edit {}; reverting to original copy'.format(path))
-        _restore_file(temp_file=temp_file, path=path)
+        LOGGER.critical('Failed to edit {}; original file left untouched'.format(path))
         raise FileEditFailedError('Failed to edit file {}'.format(path))
 
-    return temp_file
+    return snapshot
 
 
 def _load_config(config_path):
     """
     Load configuration file
+
+    The parsed configuration is cached as JSON next to the YAML file together with the
+    YAML file's modification time, size and SHA-256 hash. The cache is only used when
+    all three still match the YAML file exactly.
+
     Args:
         config_path (str): Path to the configuration file, which must be in YAML syntax
 
@@ -173,13 +292,41 @@ def _load_config(config_path):
     Raises:
         LoadConfigError
     """
+    cache_path = config_path + CONFIG_CACHE_SUFFIX
+    try:
+        stat_result = os.stat(config_path)
+        with open(config_path, 'rb') as fp:
+            content = fp.read()
+    except OSError as e:
+        raise LoadConfigError('Could not load configuration file: {}'.format(str(e)))
+    source = {'mtime_ns': stat_result.st_mtime_ns,
+              'size': stat_result.st_size,
+              'sha256': hashlib.sha256(content).hexdigest()}
+
+    try:
+        with open(cache_path, 'r') as fp:
+            cache = json.load(fp)
+        if isinstance(cache, dict) and cache.get('source') == source:
+            LOGGER.info('Loaded cached config from {}'.format(cache_path))
+            return cache['configs']
+    except (OSError, ValueError, KeyError):
+        pass
+
     try:
-        with open(config_path, 'r') as fp:
-            configs = list(yaml.load_all(fp))
-        return configs
+        configs = list(yaml.load_all(content, Loader=_Loader))
     except Exception as e:
         raise LoadConfigError('Could not load configuration file: {}'.format(str(e)))
 
+    try:
+        with open(cache_path, 'w') as fp:
+            json.dump({'source': source, 'configs': configs}, fp)
+    except (OSError, TypeError, ValueError):
+        LOGGER.info('Could not cache config to {}'.format(cache_path))
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    return configs
+
 
 def _parse_config(configs):
     """
@@ -209,8 +356,8 @@ def _expand_configs(configs):
     Args:
         configs (list): List of dictionaries
 
-    Returns:
-        (list) Expanded configs
+    Yields:
+        (list) Expanded configs, one edit strategy at a time
 
     Detailed description:
     Expanding a config file should look like the following:
@@ -280,54 +427,255 @@ def _expand_configs(configs):
     ]
 
     """
-    list_all_strategies = []
-
-    dict_idx_to_file = {}
-    dict_idx_to_line_number = {}
-    dict_idx_to_var_name = {}
+    # (path, line_number, var_name) of each value slot in the product
+    list_slots = []
 
     # File name => list of edit instructions
     dict_file_to_edit_instructions = {}
 
     list_args_for_product = []
-    running_idx = 0
     for dict_config in configs:
         path = dict_config['path']
         dict_file_to_edit_instructions[path] = []
         for config in dict_config['configurations']:
-            line_number = config['line_number']
-            variable = config['variable']
-            dict_idx_to_file[running_idx] = path
-            dict_idx_to_line_number[running_idx] = line_number
-            dict_idx_to_var_name[running_idx] = variable
+            list_slots.append((path, config['line_number'], config['variable']))
             values = config['value']
-            if type(values) is list:
-                list_args_for_product.append(values)
-            else:
-                list_args_for_product.append([values])
-            running_idx += 1
-
-    list_all_products = list(itertools.product(*list_args_for_product))
-    for list_strategy_values in list_all_products:
-        dict_file_to_edit_instructions_copy = copy.deepcopy(dict_file_to_edit_instructions)
+            list_args_for_product.append(values if isinstance(values, (list, tuple)) else (values,))
+
+    for list_strategy_values in itertools.product(*list_args_for_product):
+        dict_file_to_edit_instructions_copy = {path: [] for path in dict_file_to_edit_instructions}
         for value_idx, value in enumerate(list_strategy_values):
-            path = dict_idx_to_file[value_idx]
-            line_number = dict_idx_to_line_number[value_idx]
-            var_name = dict_idx_to_var_name[value_idx]
+            path, line_number, var_name = list_slots[value_idx]
             dict_file_to_edit_instructions_copy[path].append((line_number, var_name, value))
 
-        list_all_strategies.append(list(dict_file_to_edit_instructions_copy.items()))
+        yield list(dict_file_to_edit_instructions_copy.items())
+
+
+def _count_strategies(configs):
+    """
+    Count the edit strategies _expand_configs will yield without expanding them
+    Args:
+        configs (list): List of dictionaries
+
+    Returns:
+        (int) Number of edit strategies
+    """
+    num_strategies = 1
+    for dict_config in configs:
+        for config in dict_config['configurations']:
+            values = config['value']
+            if isinstance(values, (list, tuple)):
+                num_strategies *= len(values)
+    return num_strategies
+
+
+def _validate_configs(configs, dict_path_to_lines):
+    """
+    Checks that every configured variable can be edited at its line before any file is edited
+    Args:
+        configs (list): List of dictionaries
+        dict_path_to_lines (dict): mapping of path => lines of the file
+
+    Returns:
+        (dict) mapping of var_name => compiled REGEX_SEARCH, to be passed on to edit_file
+
+    Raises:
+        LoadConfigError
+        VariableNotFoundError
+        VariableNotDeclaredAtLineError
+    """
+    dict_var_name_to_search_re = {}
+    for dict_config in configs:
+        path = dict_config['path']
+        lines = dict_path_to_lines[path]
+        for config in dict_config['configurations']:
+            line_number = config['line_number']
+            variable = config['variable']
+            if type(line_number) is not int:
+                raise LoadConfigError('In {}: line_number must be an integer, got {!r}'
+                                      .format(path, line_number))
+            if not isinstance(variable, str):
+                raise LoadConfigError('In {}: variable must be a string, got {!r}'
+                                      .format(path, variable))
+            if variable not in dict_var_name_to_search_re:
+                dict_var_name_to_search_re.update(_compile_search_patterns([variable]))
+            try:
+                line = _get_line(lines, line_number)
+            except VariableNotFoundError as e:
+                raise VariableNotFoundError('In {}: {}'.format(path, e.message))
+            try:
+                # Dry run of the edit edit_file will make
+                _edit_line(line, variable, '', dict_var_name_to_search_re[variable])
+            except VariableNotFoundError as e:
+                raise VariableNotFoundError('In {}, line {}: {}'
+                                            .format(path, line_number, e.message))
+            except VariableNotDeclaredAtLineError as e:
+                raise VariableNotDeclaredAtLineError('In {}, line {}: {}'
+                                                     .format(path, line_number, e.message))
+    return dict_var_name_to_search_re
+
+
+def _run_strategy(idx, num_strategies, list_edit_strategy, command, verbose, settle,
+                  dict_path_to_snapshot, dict_path_to_lines, dict_var_name_to_search_re,
+                  dict_path_to_backup, dict_path_to_last_written, workdir=None):
+    """
+    Applies one edit strategy and runs the command
+
+    Edited files are left as they are so that a following strategy with the same
+    instructions for a file does not have to rewrite it; the caller restores them
+    from dict_path_to_backup once all strategies have run.
+
+    Args:
+        idx (int): Index of the edit strategy
+        num_strategies (int): Total number of edit strategies
+        list_edit_strategy (list): List of (path, instructions) pairs
+        command (list): A shell command in list format
+        verbose (bool): Whether to print the edited files
+        settle (float): Seconds to wait after editing each file
+        dict_path_to_snapshot (dict): mapping of path => original contents
+        dict_path_to_lines (dict): mapping of path => original lines
+        dict_var_name_to_search_re (dict): mapping of var_name => compiled REGEX_SEARCH
+        dict_path_to_backup (dict): mapping of edited path => original contents; updated
+        dict_path_to_last_written (dict): mapping of edited path => instructions it
+            currently holds; updated
+        workdir (str): Directory the paths are relative to and the command is run in;
+            the current working directory if not given
+
+    Returns:
+        None
+    """
+    LOGGER.warning('Going through edit {}/{}'.format(idx + 1, num_strategies))
+    if workdir is not None:
+        LOGGER.warning('Working directory is: {}'.format(workdir))
+
+    for (path, instructions) in list_edit_strategy:
+        target_path = path if workdir is None else os.path.join(workdir, path)
+        # Values are written as strings, so compare them the same way
+        written = tuple((line_number, var_name, str(value))
+                        for (line_number, var_name, value) in instructions)
+        if dict_path_to_last_written.get(target_path) == written:
+            LOGGER.info('{} already holds this configuration; skipping edit'.format(path))
+            continue
+
+        # Edit the file
+        try:
+            snapshot = edit_file(target_path, instructions,
+                                 snapshot=dict_path_to_snapshot[path],
+                                 lines=dict_path_to_lines[path],
+                                 dict_var_name_to_search_re=dict_var_name_to_search_re)
+            if verbose:
+                LOGGER.info('Edited file looks like:')
+                subprocess.run(['cat', target_path])
+
+            dict_path_to_backup[target_path] = snapshot
+            dict_path_to_last_written[target_path] = written
+            if settle > 0:
+                time.sleep(settle)
+        except (VariableNotFoundError, VariableNotDeclaredAtLineError) as e:
+            LOGGER.error('Error updating file {} with the following instructions:'.format(path))
+            LOGGER.error('{}'.format(instructions))
+            LOGGER.error('{}'.format(e.message))
+            sys.exit(1)
+        except FileEditFailedError as e:
+            LOGGER.error('Error updating file {} with the following instructions:'.format(path))
+            LOGGER.error('{}'.format(instructions))
+            LOGGER.error('{}'.format(e.message))
+            sys.exit(1)
+
+    try:
+        output_file = tempfile.NamedTemporaryFile(delete=False)
+        conf = 'Configuration is: {}'.format(list_edit_strategy)
+        LOGGER.warning(conf)
+        output_file.write('{}\n'.format(conf).encode('utf-8'))
+        output_file.flush()
+        LOGGER.warning('Logs can be found here: {}'.format(output_file.name))
+        code = subprocess.Popen(command, stdout=output_file, stderr=output_file,
+                                cwd=workdir).wait()
+        LOGGER.info('Command ended with code {}'.format(code))
+        output_file.close()
+    except:
+        LOGGER.error('Unable to run subprocess {}'.format(command))
 
-    return list_all_strategies
 
+def _create_workdirs(root, workers, list_paths):
+    """
+    Creates copies of the current working directory for parallel workers
+
+    Version control and cache directories are left out of the copies, and virtualenvs
+    are symlinked rather than copied. Configured paths that are symlinks become regular
+    files in the copies so that editing them never reaches the original tree.
+
+    Args:
+        root (str): Directory to create the copies in
+        workers (int): Number of copies
+        list_paths (list): Configured paths, relative to the working directory
 
-def main(config_path, command, verbose):
+    Returns:
+        (list) Paths to the copies
+
+    Raises:
+        FileEditFailedError
+    """
+    cwd = os.getcwd()
+    abs_root = os.path.abspath(root)
+    list_abs_paths = [os.path.abspath(path) for path in list_paths]
+
+    list_workdirs = []
+    for worker_idx in range(workers):
+        workdir = os.path.join(root, str(worker_idx))
+        # Directories (relative to cwd) to symlink into the copy instead of copying
+        list_links = []
+
+        def ignore(directory, names):
+            abs_directory = os.path.abspath(directory)
+            list_ignored = []
+            for name in names:
+                abs_name = os.path.join(abs_directory, name)
+                # The copies may live inside the working directory (e.g. when TMPDIR points there)
+                if abs_name == abs_root:
+                    list_ignored.append(name)
+                elif any(abs_path == abs_name or abs_path.startswith(abs_name + os.sep)
+                         for abs_path in list_abs_paths):
+                    continue
+                elif name in WORKDIR_SKIPPED_DIRS:
+                    list_ignored.append(name)
+                elif os.path.isfile(os.path.join(abs_name, 'pyvenv.cfg')):
+                    list_ignored.append(name)
+                    list_links.append(os.path.relpath(abs_name, cwd))
+            return list_ignored
+
+        shutil.copytree(cwd, workdir, symlinks=True, ignore=ignore)
+        for link in list_links:
+            os.symlink(os.path.join(cwd, link), os.path.join(workdir, link))
+
+        real_workdir = os.path.realpath(workdir)
+        for path in list_paths:
+            workdir_path = os.path.join(workdir, path)
+            if os.path.islink(workdir_path):
+                os.remove(workdir_path)
+                shutil.copy(path, workdir_path)
+            if not os.path.realpath(workdir_path).startswith(real_workdir + os.sep):
+                raise FileEditFailedError('Path {} resolves outside the working directory'
+                                          .format(path))
+        list_workdirs.append(workdir)
+    return list_workdirs
+
+
+def main(config_path, command, verbose, settle=0.0, workers=1, keep_workdirs=False):
     """
     Main function
 
     Args:
         config_path (str): Path to configuration
         command (list): A shell command in list format
+        verbose (bool): Whether to print the edited files
+        settle (float): Seconds to wait after editing each file
+        workers (int): Number of edit strategies to run at once, capped at the number
+            of strategies. With more than one, each worker edits and runs the command in
+            its own copy of the current working directory, so all configured paths and
+            any references to them in the command must be relative to it.
+        keep_workdirs (bool): Keep the workers' copies of the working directory after the
+            run instead of deleting them, e.g. to collect files the command wrote there
 
     Returns:
         None
@@ -341,62 +689,120 @@ def main(config_path, command, verbose):
     try:
         LOGGER.info('Loading config from {}'.format(config_path))
         configs = _load_config(config_path)
-        LOGGER.info('Loading successful:')
-        pprint(configs)
+        LOGGER.info('Loading successful')
+        if verbose:
+            pprint(configs)
     except LoadConfigError as e:
         LOGGER.error(e.message)
         sys.exit(1)
 
+    num_strategies = _count_strategies(configs)
+    workers = min(workers, num_strategies)
+
+    # Read each file once; every strategy edits a copy of its lines
+    dict_path_to_snapshot = {}
+    dict_path_to_lines = {}
+    for dict_config in configs:
+        path = dict_config['path']
+        outside_cwd = os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == os.pardir
+        if workers > 1 and outside_cwd:
+            LOGGER.error('Path {} must be inside the working directory to use workers'.format(path))
+            sys.exit(1)
+        try:
+            dict_path_to_snapshot[path] = _snapshot(path)
+        except OSError as e:
+            LOGGER.error('Could not read file {}: {}'.format(path, e))
+            sys.exit(1)
+        dict_path_to_lines[path] = _split_lines(dict_path_to_snapshot[path])
+
+    if workers > 1:
+        # Workers edit their own copies, so an absolute reference would run the original
+        for path in dict_path_to_snapshot:
+            set_abs_paths = {os.path.abspath(path), os.path.realpath(path)}
+            for arg in command:
+                if any(abs_path in arg for abs_path in set_abs_paths):
+                    LOGGER.error('Command argument {} refers to {} by absolute path; '
+                                 'use a relative path to use workers'.format(arg, path))
+                    sys.exit(1)
+
+    # Fail before any file is edited or any command is run
+    try:
+        dict_var_name_to_search_re = _validate_configs(configs, dict_path_to_lines)
+    except (LoadConfigError, VariableNotFoundError, VariableNotDeclaredAtLineError) as e:
+        LOGGER.error(e.message)
+        sys.exit(1)
+
     list_edit_strategies = _expand_configs(configs)
 
     # Start running experiments
-    for idx, list_edit_strategy in enumerate(list_edit_strategies):
-        LOGGER.warning('Going through edit {}/{}'.format(idx + 1, len(list_edit_strategies)))
-        # Store the backup location of each file
+    if workers <= 1:
+        # Store the original contents of each edited file
         dict_path_to_backup = {}
+        dict_path_to_last_written = {}
+        try:
+            for idx, list_edit_strategy in enumerate(list_edit_strategies):
+                _run_strategy(idx, num_strategies, list_edit_strategy, command, verbose, settle,
+                              dict_path_to_snapshot, dict_path_to_lines,
+                              dict_var_name_to_search_re, dict_path_to_backup,
+                              dict_path_to_last_written)
+        finally:
+            _restore_from_dict(dict_path_to_backup)
+        return
 
-        for (path, instructions) in list_edit_strategy:
-            # Edit the file
-            try:
-                temp_file = edit_file(path, instructions)
-                if verbose:
-                    LOGGER.info('Edited file looks like:')
-                    subprocess.run(['cat', path])
-
-                dict_path_to_backup[path] = temp_file
-                time.sleep(0.5)
-            except VariableNotFoundError as e:
-                LOGGER.error('Error updating file {} with the following instructions:'.format(path))
-                LOGGER.error('{}'.format(instructions))
-                LOGGER.error('{}'.format(e.message))
-                sys.exit(1)
-            except FileEditFailedError as e:
-                LOGGER.error('Error updating file {} with the following instructions:'.format(path))
-                LOGGER.error('{}'.format(instructions))
-                LOGGER.error('{}'.format(e.message))
-                sys.exit(1)
+    # Strategies share an iterator so they are still expanded one at a time
+    enumerated_strategies = enumerate(list_edit_strategies)
+    lock = threading.Lock()
+    stop = threading.Event()
 
+    def run_worker(workdir):
+        dict_path_to_backup = {}
+        dict_path_to_last_written = {}
         try:
-            output_file = tempfile.NamedTemporaryFile(delete=False)
-            conf = 'Configuration is: {}'.format(list_edit_strategy)
-            LOGGER.warning(conf)
-            output_file.write('{}\n'.format(conf).encode('utf-8'))
-            output_file.flush()
-            LOGGER.warning('Logs can be found here: {}'.format(output_file.name))
-            code = subprocess.Popen(command, stdout=output_file, stderr=output_file).wait()
-            LOGGER.info('Command ended with code {}'.format(code))
-            output_file.close()
-        except:
-            LOGGER.error('Unable to run subprocess {}'.format(command))
+            while not stop.is_set():
+                with lock:
+                    item = next(enumerated_strategies, None)
+                if item is None:
+                    return
+                idx, list_edit_strategy = item
+                _run_strategy(idx, num_strategies, list_edit_strategy, command, verbose, settle,
+                              dict_path_to_snapshot, dict_path_to_lines,
+                              dict_var_name_to_search_re, dict_path_to_backup,
+                              dict_path_to_last_written, workdir=workdir)
+        except BaseException:
+            stop.set()
+            raise
         finally:
             _restore_from_dict(dict_path_to_backup)
-            _clear_from_dict(dict_path_to_backup)
+
+    root = tempfile.mkdtemp(prefix='softshell-')
+    if keep_workdirs:
+        LOGGER.warning('Working directory copies can be found here: {}'.format(root))
+    try:
+        try:
+            list_workdirs = _create_workdirs(root, workers, list(dict_path_to_snapshot))
+        except FileEditFailedError as e:
+            LOGGER.error(e.message)
+            sys.exit(1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_worker, workdir) for workdir in list_workdirs]
+        for future in futures:
+            future.result()
+    finally:
+        if not keep_workdirs:
+            shutil.rmtree(root, ignore_errors=True)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='softshell', allow_abbrev=False)
     parser.add_argument('-f', required=True, type=str, help='Path to config file')
     parser.add_argument('--verbose', action='store_true', help='Set verbosity')
+    parser.add_argument('--settle', type=float, default=0.0,
+                        help='Seconds to wait after editing each file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of edit strategies to run in parallel, each in its own '
+                             'copy of the working directory')
+    parser.add_argument('--keep-workdirs', action='store_true',
+                        help='Keep the workers\' copies of the working directory after the run')
     parser.add_argument('command', nargs='*',
                         help='Please provide the command to run')
     args = parser.parse_args()
@@ -404,8 +810,9 @@ if __name__ == '__main__':
     config_path = args['f']
     command = args['command']
     verbose = args['verbose']
-
-    yaml.warnings({'YAMLLoadWarning': False})
+    settle = args['settle']
+    workers = args['workers']
+    keep_workdirs = args['keep_workdirs']
 
     if verbose:
         logging.basicConfig(level=logging.DEBUG,
@@ -414,4 +821,5 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.WARNING,
                             format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 
-    main(config_path=config_path, command=command, verbose=verbose)
+    main(config_path=config_path, command=command, verbose=verbose, settle=settle,
+         workers=workers, keep_workdirs=keep_workdirs)